@@ -1,41 +1,108 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
-import csv
+import hashlib
+import heapq
+import io
 import json
+import mmap
+import multiprocessing
+import os
 import re
+import shutil
 import sys
+import tempfile
 import xml.etree.ElementTree as ET
-from dataclasses import dataclass
+from array import array
+from collections import defaultdict
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+from dataclasses import dataclass, field
+from itertools import repeat
 from pathlib import Path
+from typing import BinaryIO
 
+try:
+    import lxml.etree as LET
+except ImportError:  # optional: fall back to the stdlib parser
+    LET = None
 
-TITLE_RE = re.compile(r"^(.*) \(([0-9,]+) samples?, ([0-9.]+)%\)$")
+try:
+    import orjson
+except ImportError:  # optional: fall back to the stdlib encoder
+    orjson = None
+
+
+# Frames are matched with and without the SVG namespace, like the stdlib
+# fallback's local_name() does.
+SVG_G = ("{http://www.w3.org/2000/svg}g", "g")
+
+if LET is not None:
+    # smart_strings=False: plain str results don't keep the frame alive.
+    FIND_TITLE = LET.XPath("*[local-name()='title'][1]/text()", smart_strings=False)
+    FIND_RECT = LET.XPath("*[local-name()='rect'][1]")
+
+# csv.writer's default line terminator, kept so the output is unchanged.
+CSV_EOL = "\r\n"
+CSV_HEADER = "function,samples,percent,x,y,width,height" + CSV_EOL
+
+# Cache entries are tied to this exact script: any edit to the parser or the
+# writers invalidates them, with no version number to remember to bump.
+CACHE_VERSION = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:16]
+
+# Sample counts may use thousands separators ("1,234") but start with a digit.
+TITLE_RE = re.compile(r"^(.*) \(([0-9][0-9,]*) samples?, ([0-9.]+)%\)$")
+
+
+@dataclass
+class Nodes:
+    """Parsed frames as parallel columns, one entry per frame."""
+
+    functions: list[str] = field(default_factory=list)
+    samples: array = field(default_factory=lambda: array("q"))
+    percents: array = field(default_factory=lambda: array("d"))
+    xs: list[str] = field(default_factory=list)
+    ys: list[str] = field(default_factory=list)
+    widths: list[str] = field(default_factory=list)
+    heights: list[str] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.functions)
 
 
 @dataclass
-class Node:
-    function: str
-    samples: int
-    percent: float
-    x: str
-    y: str
-    width: str
-    height: str
+class Args:
+    svgs: list[Path]
+    out_prefix: Path | None = None
+    use_cache: bool = True
+    # "compact", "pretty" (indented) or "ndjson" (one record per line).
+    json_format: str = "compact"
+    # Keep only the N functions with the most samples; None keeps all.
+    top: int | None = None
 
 
 class UsageError(Exception):
     pass
 
 
-def parse_args(argv: list[str]) -> tuple[Path, Path | None]:
-    svg: Path | None = None
+USAGE = (
+    "usage: flamegraph_to_csv <svg>... [--out-prefix PATH] [--no-cache]"
+    " [--pretty | --ndjson] [--top N]"
+)
+
+
+def parse_args(argv: list[str]) -> Args:
+    svgs: list[Path] = []
     out_prefix: Path | None = None
+    use_cache = True
+    json_format = "compact"
+    top: int | None = None
 
     it = iter(argv)
     for arg in it:
         if arg in ("--help", "-h"):
-            raise UsageError("usage: flamegraph_to_csv <svg> [--out-prefix PATH]")
+            raise UsageError(USAGE)
         if arg == "--out-prefix":
             try:
                 value = next(it)
@@ -43,29 +110,40 @@ def parse_args(argv: list[str]) -> tuple[Path, Path | None]:
                 raise ValueError("--out-prefix requires a value") from exc
             out_prefix = Path(value)
             continue
-
-        if svg is None:
-            svg = Path(arg)
+        if arg == "--top":
+            try:
+                top = int(next(it))
+            except (StopIteration, ValueError) as exc:
+                raise ValueError("--top requires a non-negative integer") from exc
+            if top < 0:
+                raise ValueError("--top requires a non-negative integer")
+            continue
+        if arg == "--no-cache":
+            use_cache = False
+            continue
+        if arg in ("--pretty", "--ndjson"):
+            if json_format != "compact":
+                raise ValueError("--pretty and --ndjson are mutually exclusive")
+            json_format = arg[2:]
             continue
 
-        raise ValueError(f"unknown arg: {arg}")
-
-    if svg is None:
-        raise UsageError("usage: flamegraph_to_csv <svg> [--out-prefix PATH]")
+        if arg.startswith("-"):
+            raise ValueError(f"unknown arg: {arg}")
 
-    return svg, out_prefix
+        svgs.append(Path(arg))
 
+    if not svgs:
+        raise UsageError(USAGE)
+    if out_prefix is not None and len(svgs) > 1:
+        raise ValueError("--out-prefix requires a single SVG")
 
-def strip_doctype(svg_text: str) -> str:
-    while True:
-        start = svg_text.find("<!DOCTYPE")
-        if start == -1:
-            break
-        end_rel = svg_text[start:].find(">")
-        if end_rel == -1:
-            break
-        svg_text = svg_text[:start] + svg_text[start + end_rel + 1 :]
-    return svg_text
+    return Args(
+        svgs=svgs,
+        out_prefix=out_prefix,
+        use_cache=use_cache,
+        json_format=json_format,
+        top=top,
+    )
 
 
 def local_name(tag: str) -> str:
@@ -74,20 +152,115 @@ def local_name(tag: str) -> str:
     return tag
 
 
-def parse_svg(svg_path: Path) -> list[Node]:
-    svg_text = svg_path.read_text()
-    svg_text = strip_doctype(svg_text)
+def parse_title(title_text: str) -> tuple[str, int, float] | None:
+    # Fast path for the fixed "<function> (N samples, P%)" suffix; the regex
+    # only runs for titles the slicing below cannot vouch for.
+    if title_text.endswith("%)"):
+        function, sep, tail = title_text.rpartition(" (")
+        samples_str, sep2, pct_str = tail[:-2].partition(" samples, ")
+        if not sep2:
+            samples_str, sep2, pct_str = tail[:-2].partition(" sample, ")
+        digits = samples_str.replace(",", "")
+        if (
+            sep
+            and sep2
+            and "\n" not in function
+            and samples_str[:1] != ","
+            and digits.isascii()
+            and digits.isdigit()
+            and pct_str.isascii()
+            and pct_str.replace(".", "", 1).isdigit()
+        ):
+            return function, int(digits), float(pct_str)
+
+    match = TITLE_RE.match(title_text)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2).replace(",", "")), float(match.group(3))
+
+
+def is_frame_group(g) -> bool:
+    # FlameGraph.pl marks frame groups with class="func_g" and inferno emits
+    # them bare; anything else with a class or an id (the "frames" container,
+    # search/zoom chrome) is never a frame.
+    group_class = g.get("class")
+    if group_class is not None:
+        return group_class == "func_g"
+    return g.get("id") is None
+
+
+def lxml_frame(g) -> tuple[str, object] | None:
+    if not is_frame_group(g):
+        return None
+    titles = FIND_TITLE(g)
+    rects = FIND_RECT(g)
+    if not (titles and rects):
+        return None
+    title_text = titles[0].strip()
+    if not title_text:
+        return None
+    return title_text, rects[0]
+
+
+def iter_frames_lxml(svg_path: Path) -> Iterator[tuple[str, object]]:
+    # Open groups as [element, handled]. Frames are yielded in document
+    # order, like the ElementTree walk: a group that contains nested groups
+    # is handled when its first child group starts, since its own title and
+    # rect precede that child.
+    open_groups: list[list] = []
+
+    with svg_path.open("rb") as handle:
+        for event, g in LET.iterparse(
+            handle,
+            events=("start", "end"),
+            tag=SVG_G,
+            huge_tree=True,
+            remove_blank_text=True,
+            resolve_entities=False,
+            no_network=True,
+        ):
+            if event == "start":
+                if open_groups and not open_groups[-1][1]:
+                    parent = open_groups[-1]
+                    frame = lxml_frame(parent[0])
+                    if frame is not None:
+                        yield frame
+                    parent[1] = frame is not None or not is_frame_group(parent[0])
+                open_groups.append([g, False])
+                continue
 
-    root = ET.fromstring(svg_text)
-    nodes: list[Node] = []
+            _, handled = open_groups.pop()
+            if not handled:
+                frame = lxml_frame(g)
+                if frame is not None:
+                    yield frame
+
+            # Drop the frame and the sibling groups already handled so the
+            # tree never grows beyond the current path. Other siblings stay:
+            # with nested groups they are the enclosing frame's title/rect.
+            g.clear()
+            previous = g.getprevious()
+            while previous is not None and previous.tag in SVG_G:
+                g.getparent().remove(previous)
+                previous = g.getprevious()
+
+
+def iter_frames_etree(svg_path: Path) -> Iterator[tuple[str, object]]:
+    # Let expat read the raw bytes straight from the mapping: it skips the
+    # DOCTYPE itself, so there is no decode or copy of the whole file.
+    parser = ET.XMLParser()
+    with svg_path.open("rb") as handle:
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            parser.feed(mapped)
+    root = parser.close()
 
     for g in root.iter():
-        if local_name(g.tag) != "g":
+        if local_name(g.tag) != "g" or not is_frame_group(g):
             continue
 
         title_text: str | None = None
         rect = None
-        for child in list(g):
+        for child in g:
             if not isinstance(child.tag, str):
                 continue
             name = local_name(child.tag)
@@ -101,54 +274,111 @@ def parse_svg(svg_path: Path) -> list[Node]:
         if not title_text or rect is None:
             continue
 
-        match = TITLE_RE.match(title_text)
-        if match is None:
+        yield title_text, rect
+
+
+def parse_svg(svg_path: Path) -> Nodes:
+    frames = iter_frames_lxml if LET is not None else iter_frames_etree
+    nodes = Nodes()
+
+    # Plain rect.get() calls beat going through rect.attrib (or copying
+    # lxml's attrib proxy into a dict) for just four attributes.
+    for title_text, rect in frames(svg_path):
+        parsed = parse_title(title_text)
+        if parsed is None:
             continue
 
-        function = match.group(1)
-        samples = int(match.group(2).replace(",", ""))
-        percent = float(match.group(3))
-
-        nodes.append(
-            Node(
-                function=function,
-                samples=samples,
-                percent=percent,
-                x=rect.get("x", ""),
-                y=rect.get("y", ""),
-                width=rect.get("width", ""),
-                height=rect.get("height", ""),
-            )
-        )
+        function, samples, percent = parsed
+        # The same frame name recurs once per stack; share one string object.
+        nodes.functions.append(sys.intern(function))
+        nodes.samples.append(samples)
+        nodes.percents.append(percent)
+        nodes.xs.append(rect.get("x", ""))
+        nodes.ys.append(rect.get("y", ""))
+        nodes.widths.append(rect.get("width", ""))
+        nodes.heights.append(rect.get("height", ""))
 
     return nodes
 
 
-def write_nodes_csv(nodes: list[Node], out_path: Path) -> None:
-    with out_path.open("w", newline="") as handle:
-        writer = csv.writer(handle)
-        writer.writerow(["function", "samples", "percent", "x", "y", "width", "height"])
-        for node in nodes:
-            writer.writerow(
-                [
-                    node.function,
-                    str(node.samples),
-                    f"{node.percent:.2f}",
-                    node.x,
-                    node.y,
-                    node.width,
-                    node.height,
-                ]
-            )
+def csv_quote(value: str) -> str:
+    # Same rules as csv.writer's QUOTE_MINIMAL; frame fields rarely need it.
+    if "," in value or '"' in value or "\n" in value or "\r" in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def write_nodes_csv(nodes: Nodes, out_path: Path) -> None:
+    rows = zip(
+        nodes.functions,
+        map(str, nodes.samples),
+        map("{:.2f}".format, nodes.percents),
+        nodes.xs,
+        nodes.ys,
+        nodes.widths,
+        nodes.heights,
+    )
+
+    lines: list[str] = []
+    for row in rows:
+        line = ",".join(row)
+        # Quote field by field only when the joined row shows it is needed.
+        if line.count(",") != 6 or '"' in line or "\n" in line or "\r" in line:
+            line = ",".join(map(csv_quote, row))
+        lines.append(line)
+    lines.append("")
+
+    with out_path.open("w", buffering=1 << 20, newline="") as handle:
+        handle.write(CSV_HEADER)
+        handle.write(CSV_EOL.join(lines))
+
+
+def json_encoder(json_format: str) -> str:
+    # orjson writes non-ASCII and small floats differently from stdlib json.
+    # --pretty output gets checked in, so it always uses stdlib json to stay
+    # the same whichever optional packages are installed.
+    if orjson is not None and json_format != "pretty":
+        return "orjson"
+    return "json"
+
+
+def dump_json(payload, json_format: str = "compact") -> bytes:
+    if json_encoder(json_format) == "orjson":
+        return orjson.dumps(payload)
+    if json_format == "pretty":
+        return json.dumps(payload, indent=2).encode()
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def sum_samples(
+    nodes: Nodes, top: int | None = None
+) -> tuple[list[str], list[int], int]:
+    """Total samples per function, ordered by samples desc then name.
+
+    Only the first ``top`` functions are returned when it is set. The third
+    value is the grand total: the root frame ("all") if present, otherwise
+    the sum over all functions.
+    """
+    counts: defaultdict[str, int] = defaultdict(int)
+    for function, samples in zip(nodes.functions, nodes.samples):
+        counts[function] += samples
+    total = counts.get("all", sum(counts.values()))
 
+    def rank(item: tuple[str, int]) -> tuple[int, str]:
+        return -item[1], item[0]
 
-def write_top_json(nodes: list[Node], out_path: Path) -> None:
-    counts: dict[str, int] = {}
-    for node in nodes:
-        counts[node.function] = counts.get(node.function, 0) + node.samples
+    if top is None:
+        items = sorted(counts.items(), key=rank)
+    else:
+        items = heapq.nsmallest(top, counts.items(), key=rank)
+    return [function for function, _ in items], [samples for _, samples in items], total
 
-    total = counts.get("all", sum(counts.values()))
-    items = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+def write_top_json(
+    nodes: Nodes, out_path: Path, json_format: str = "compact", top: int | None = None
+) -> None:
+    functions, totals, total = sum_samples(nodes, top)
+    items = zip(functions, totals)
 
     payload = [
         {
@@ -159,39 +389,163 @@ def write_top_json(nodes: list[Node], out_path: Path) -> None:
         for function, samples in items
     ]
 
-    with out_path.open("w") as handle:
-        json.dump(payload, handle, indent=2)
-        handle.write("\n")
+    with out_path.open("wb") as handle:
+        if json_format == "ndjson":
+            handle.write(
+                b"".join(dump_json(record, json_format) + b"\n" for record in payload)
+            )
+        else:
+            handle.write(dump_json(payload, json_format))
+            handle.write(b"\n")
 
 
-def run(argv: list[str]) -> int:
-    try:
-        svg, out_prefix = parse_args(argv)
-    except UsageError as exc:
-        print(exc, file=sys.stderr)
-        return 1
-    except ValueError as exc:
-        print(str(exc), file=sys.stderr)
-        return 1
+def cache_dir() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "serde_toon" / "flamegraph" / CACHE_VERSION
 
-    if not svg.exists():
-        print(f"SVG not found: {svg}", file=sys.stderr)
-        return 1
 
-    prefix = out_prefix if out_prefix is not None else svg.with_suffix("")
+def svg_digest(svg_path: Path) -> str:
+    with svg_path.open("rb") as handle:
+        if hasattr(hashlib, "file_digest"):
+            digest = hashlib.file_digest(handle, "sha256")
+        else:
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: handle.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def cached_outputs(key: str) -> tuple[Path, Path, Path]:
+    base = cache_dir()
+    return (
+        base / f"{key}.nodes.csv",
+        base / f"{key}.top.json",
+        base / f"{key}.done",
+    )
+
+
+def cached_sizes(cached_csv: Path, cached_json: Path) -> str:
+    return f"{cached_csv.stat().st_size} {cached_json.stat().st_size}"
+
+
+def restore_cached(key: str, nodes_csv: Path, top_json: Path) -> bool:
+    # An entry only counts once its marker exists and still matches the
+    # sizes recorded when both files were committed.
+    cached_csv, cached_json, marker = cached_outputs(key)
+    try:
+        if marker.read_text() != cached_sizes(cached_csv, cached_json):
+            return False
+        shutil.copyfile(cached_csv, nodes_csv)
+        shutil.copyfile(cached_json, top_json)
+    except OSError:
+        return False
+    return True
+
+
+def write_atomically(target: Path, source: BinaryIO) -> None:
+    # Write next to the target and rename into place, so readers (or
+    # parallel workers storing the same key) never see a partial file.
+    fd, tmp_name = tempfile.mkstemp(dir=target.parent, prefix=target.name + ".")
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            shutil.copyfileobj(source, handle)
+        os.replace(tmp_name, target)
+    except BaseException:
+        with suppress(OSError):
+            os.unlink(tmp_name)
+        raise
+
+
+def store_cached(key: str, nodes_csv: Path, top_json: Path) -> None:
+    # Best effort: a cache that cannot be written just means a re-parse.
+    cached_csv, cached_json, marker = cached_outputs(key)
+    try:
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        with nodes_csv.open("rb") as source:
+            write_atomically(cached_csv, source)
+        with top_json.open("rb") as source:
+            write_atomically(cached_json, source)
+        # The marker goes last: it commits the pair.
+        sizes = cached_sizes(cached_csv, cached_json).encode()
+        write_atomically(marker, io.BytesIO(sizes))
+    except OSError:
+        pass
+
+
+def convert(svg: Path, prefix: Path, args: Args) -> tuple[bool, str]:
+    """Write the CSV/JSON pair for one SVG; returns (ok, message)."""
     nodes_csv = prefix.with_suffix(".nodes.csv")
-    top_json = prefix.with_suffix(".top.json")
+    top_suffix = ".top.ndjson" if args.json_format == "ndjson" else ".top.json"
+    top_json = prefix.with_suffix(top_suffix)
 
     try:
+        # Outputs depend on the input bytes, the XML parser, the JSON options
+        # and the encoder.
+        key = None
+        if args.use_cache:
+            parser = "lxml" if LET is not None else "etree"
+            top = "all" if args.top is None else args.top
+            encoder = json_encoder(args.json_format)
+            key = (
+                f"{svg_digest(svg)}.{parser}.{args.json_format}.{encoder}.top{top}"
+            )
+        if key is not None and restore_cached(key, nodes_csv, top_json):
+            return True, f"Wrote {nodes_csv} and {top_json} (cached)"
+
         nodes = parse_svg(svg)
         write_nodes_csv(nodes, nodes_csv)
-        write_top_json(nodes, top_json)
+        write_top_json(nodes, top_json, args.json_format, args.top)
     except Exception as exc:
+        return False, str(exc)
+
+    if key is not None:
+        store_cached(key, nodes_csv, top_json)
+
+    return True, f"Wrote {nodes_csv} and {top_json} (nodes={len(nodes)})"
+
+
+def run(argv: list[str]) -> int:
+    try:
+        args = parse_args(argv)
+    except UsageError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    except ValueError as exc:
         print(str(exc), file=sys.stderr)
         return 1
 
-    print(f"Wrote {nodes_csv} and {top_json} (nodes={len(nodes)})")
-    return 0
+    for svg in args.svgs:
+        if not svg.exists():
+            print(f"SVG not found: {svg}", file=sys.stderr)
+            return 1
+
+    svgs = args.svgs
+    prefixes = [
+        args.out_prefix if args.out_prefix is not None else svg.with_suffix("")
+        for svg in svgs
+    ]
+
+    if len(svgs) == 1:
+        results = [convert(svgs[0], prefixes[0], args)]
+    else:
+        # Each SVG is independent; parse them in separate processes. The
+        # forkserver start method avoids copying this process's heap.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in methods else None
+        )
+        workers = min(len(svgs), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            results = list(pool.map(convert, svgs, prefixes, repeat(args)))
+
+    status = 0
+    for ok, message in results:
+        if ok:
+            print(message)
+        else:
+            print(message, file=sys.stderr)
+            status = 1
+    return status
 
 
 def main() -> None:
@@ -42,7 +42,4 @@ for name in characters specials universe jsonld; do
   run_decode "peanuts_${name}" "$input"
 done
 
-for svg in "$PROFILE_DIR"/*.svg; do
-  prefix="${svg%.svg}"
-  uv run python benchmarks/flamegraph_to_csv.py "$svg" --out-prefix "$prefix"
-done
+uv run python benchmarks/flamegraph_to_csv.py --pretty "$PROFILE_DIR"/*.svg